@@ -8,29 +8,215 @@ Generate normal maps from sprites for game engines.
 
 from gimpfu import *
 import os
+import threading
 
-def generate_normal_map(image, drawable, strength, invert_y, output_path):
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Input formats picked up by the batch function
+VALID_EXTENSIONS = frozenset(('.jpg', '.jpeg', '.png', '.bmp', '.tga'))
+
+# Color of a flat surface facing the viewer, used by the Sobel fallback
+FLAT_NORMAL_COLOR = (128, 128, 255)
+
+
+def _ensure_dir(path):
     """
-    Generate a normal map from the current layer.
+    Create a directory if it does not already exist.
+    Python 2 has no exist_ok, so a concurrent mkdir is tolerated here.
     
     Args:
-        image: The current image
-        drawable: The active layer
-        strength: Normal map strength multiplier
-        invert_y: Invert the Y (green) channel for different engine conventions
-        output_path: Path to save the normal map
+        path: Directory to create
     """
-    pdb.gimp_image_undo_group_start(image)
-    
     try:
-        # Duplicate the image to work non-destructively
-        work_image = pdb.gimp_image_duplicate(image)
-        work_layer = pdb.gimp_image_get_active_layer(work_image)
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _list_images(input_dir):
+    """
+    List the supported image files in a directory.
+    
+    Args:
+        input_dir: Directory to scan
+    
+    Returns:
+        File names with an extension in VALID_EXTENSIONS
+    """
+    if scandir is not None:
+        names = [entry.name for entry in scandir(input_dir) if entry.is_file()]
+    else:
+        names = os.listdir(input_dir)
+    return [f for f in names if os.path.splitext(f)[1].lower() in VALID_EXTENSIONS]
+
+
+def _prefetch(path):
+    """
+    Read a file on a background thread so it is already in the OS cache
+    when GIMP loads it. The PDB is not reentrant, so only the raw bytes
+    are read ahead; decoding still happens in gimp_file_load.
+    
+    Args:
+        path: File to read ahead
+    """
+    def read():
+        try:
+            with open(path, 'rb') as f:
+                while f.read(1 << 20):
+                    pass
+        except (IOError, OSError):
+            pass
+    
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+
+
+def _normal_map_from_height(layer, strength, invert_y):
+    """
+    Convert an RGBA layer into a normal map, using its lightness as the
+    height. Requires NumPy; alpha is left untouched.
+    
+    The layer is processed in bands of GIMP tile height so only a few
+    rows are held in memory at once, even for very large images.
+    
+    Args:
+        layer: Source layer, overwritten with the normal map
+        strength: Multiplier applied to the surface gradient
+        invert_y: Flip the Y (green) component
+    """
+    width = layer.width
+    height = layer.height
+    bpp = layer.bpp
+    band = gimp.tile_height()
+    
+    src_rgn = layer.get_pixel_rgn(0, 0, width, height, False, False)
+    dst_rgn = layer.get_pixel_rgn(0, 0, width, height, True, True)
+    
+    for y in range(0, height, band):
+        y_end = min(y + band, height)
         
-        # Ensure we have alpha
-        if not pdb.gimp_drawable_has_alpha(work_layer):
-            pdb.gimp_layer_add_alpha(work_layer)
+        # Read one extra row above and below for the 3x3 kernel
+        top = max(y - 1, 0)
+        bottom = min(y_end + 1, height)
+        pixels = np.frombuffer(src_rgn[0:width, top:bottom], dtype=np.uint8)
+        pixels = pixels.reshape(bottom - top, width, bpp)
         
+        # Lightness, as in DESATURATE_LIGHTNESS: (max + min) / 2
+        rgb = pixels[:, :, :3]
+        lightness = (rgb.max(axis=2).astype(np.float32) + rgb.min(axis=2)) / 510.0
+        
+        # Replicate borders only where the band touches the image edge
+        pad_rows = (1 if top == y else 0, 1 if bottom == y_end else 0)
+        heights = np.pad(lightness, (pad_rows, (1, 1)), mode='edge')
+        
+        # 3x3 Sobel derivatives (x to the right, y down the rows)
+        gx = ((heights[:-2, 2:] + 2 * heights[1:-1, 2:] + heights[2:, 2:]) -
+              (heights[:-2, :-2] + 2 * heights[1:-1, :-2] + heights[2:, :-2]))
+        gy = ((heights[2:, :-2] + 2 * heights[2:, 1:-1] + heights[2:, 2:]) -
+              (heights[:-2, :-2] + 2 * heights[:-2, 1:-1] + heights[:-2, 2:]))
+        
+        # Normal = normalize(-dh/dx, dh/dy, 1) with Y pointing up
+        nx = -gx * strength
+        ny = -gy * strength if invert_y else gy * strength
+        inv_len = 1.0 / np.sqrt(nx * nx + ny * ny + 1.0)
+        
+        out = pixels[y - top:y_end - top].copy()
+        out[:, :, 0] = np.rint(nx * inv_len * 127.5 + 127.5)
+        out[:, :, 1] = np.rint(ny * inv_len * 127.5 + 127.5)
+        out[:, :, 2] = np.rint(inv_len * 127.5 + 127.5)
+        
+        dst_rgn[0:width, y:y_end] = out.tobytes()
+    
+    layer.flush()
+    layer.merge_shadow(True)
+    layer.update(0, 0, width, height)
+
+
+def _normal_map_from_sobel(work_image, work_layer):
+    """
+    Approximate a normal map with GIMP's Sobel filter when NumPy is not
+    available. Expects the context foreground to be FLAT_NORMAL_COLOR.
+    
+    Args:
+        work_image: Image holding the height map
+        work_layer: Desaturated height map layer
+    
+    Returns:
+        The merged normal map layer
+    """
+    # Fallback: create normal map manually using Sobel edge detection
+    # Create X derivative layer
+    x_layer = pdb.gimp_layer_copy(work_layer, True)
+    pdb.gimp_image_insert_layer(work_image, x_layer, None, 0)
+    pdb.plug_in_sobel(work_image, x_layer, True, False, False)
+    
+    # Create Y derivative layer
+    y_layer = pdb.gimp_layer_copy(work_layer, True)
+    pdb.gimp_image_insert_layer(work_image, y_layer, None, 0)
+    pdb.plug_in_sobel(work_image, y_layer, False, True, False)
+    
+    # Decompose to RGB channels for manual construction
+    work_layer = pdb.gimp_image_flatten(work_image)
+    
+    # Normalize and add blue channel (Z is usually pointing up)
+    # This creates a basic normal map effect
+    width = work_layer.width
+    height = work_layer.height
+    
+    # Create a new layer for the blue channel (constant Z)
+    blue_layer = pdb.gimp_layer_new(work_image, width, height, 
+                                   RGBA_IMAGE, "blue", 100, NORMAL_MODE)
+    pdb.gimp_image_insert_layer(work_image, blue_layer, None, 0)
+    pdb.gimp_drawable_fill(blue_layer, FOREGROUND_FILL)
+    
+    # Merge down
+    work_layer = pdb.gimp_image_merge_down(work_image, blue_layer, EXPAND_AS_NECESSARY)
+    
+    return work_layer
+
+
+def _build_normal_map(work_image, work_layer, strength, invert_y):
+    """
+    Turn a layer into a normal map in place. The image is modified, so
+    callers pass either a duplicate or an image they own, and set the
+    context foreground to FLAT_NORMAL_COLOR.
+    
+    Args:
+        work_image: Image to modify
+        work_layer: Layer to convert
+        strength: Normal map strength multiplier
+        invert_y: Invert the Y (green) channel
+    
+    Returns:
+        The layer holding the normal map
+    """
+    # Ensure we have alpha
+    if not pdb.gimp_drawable_has_alpha(work_layer):
+        pdb.gimp_layer_add_alpha(work_layer)
+    
+    # Strength is folded into the gradient by the NumPy path
+    strength_applied = False
+    
+    if np is not None and not pdb.gimp_procedural_db_proc_exists("plug-in-normalmap"):
+        # Height, gradient and Y inversion in one pass over the pixels
+        if pdb.gimp_image_base_type(work_image) != RGB:
+            pdb.gimp_image_convert_rgb(work_image)
+        _normal_map_from_height(work_layer, strength, invert_y)
+        strength_applied = True
+    else:
         # Convert to grayscale for height map
         pdb.gimp_desaturate_full(work_layer, DESATURATE_LIGHTNESS)
         
@@ -39,35 +225,7 @@ def generate_normal_map(image, drawable, strength, invert_y, output_path):
             # Try the normalmap plugin if installed
             pdb.plug_in_normalmap(work_image, work_layer, 0, 0.0, strength, 0, 0, 0, 0, 0, 0, 0, 0)
         except:
-            # Fallback: create normal map manually using Sobel edge detection
-            # Create X derivative layer
-            x_layer = pdb.gimp_layer_copy(work_layer, True)
-            pdb.gimp_image_insert_layer(work_image, x_layer, None, 0)
-            pdb.plug_in_sobel(work_image, x_layer, True, False, False)
-            
-            # Create Y derivative layer
-            y_layer = pdb.gimp_layer_copy(work_layer, True)
-            pdb.gimp_image_insert_layer(work_image, y_layer, None, 0)
-            pdb.plug_in_sobel(work_image, y_layer, False, True, False)
-            
-            # Decompose to RGB channels for manual construction
-            pdb.gimp_image_flatten(work_image)
-            work_layer = pdb.gimp_image_get_active_layer(work_image)
-            
-            # Normalize and add blue channel (Z is usually pointing up)
-            # This creates a basic normal map effect
-            width = work_layer.width
-            height = work_layer.height
-            
-            # Create a new layer for the blue channel (constant Z)
-            blue_layer = pdb.gimp_layer_new(work_image, width, height, 
-                                           RGBA_IMAGE, "blue", 100, NORMAL_MODE)
-            pdb.gimp_image_insert_layer(work_image, blue_layer, None, 0)
-            pdb.gimp_context_set_foreground((128, 128, 255))
-            pdb.gimp_drawable_fill(blue_layer, FOREGROUND_FILL)
-            
-            # Merge down
-            work_layer = pdb.gimp_image_merge_down(work_image, blue_layer, EXPAND_AS_NECESSARY)
+            work_layer = _normal_map_from_sobel(work_image, work_layer)
         
         # Invert Y channel if requested (some engines use different conventions)
         if invert_y:
@@ -82,16 +240,42 @@ def generate_normal_map(image, drawable, strength, invert_y, output_path):
             # Recompose
             pdb.plug_in_compose(work_image, work_layer, layers[0], layers[1], layers[2], None, "RGB")
             pdb.gimp_image_delete(decomposed)
+    
+    # Apply strength by adjusting levels
+    if strength != 1.0 and not strength_applied:
+        # Adjust contrast based on strength
+        pdb.gimp_brightness_contrast(work_layer, 0, int((strength - 1.0) * 50))
+    
+    return work_layer
+
+
+def generate_normal_map(image, drawable, strength, invert_y, output_path):
+    """
+    Generate a normal map from the current layer.
+    
+    Args:
+        image: The current image
+        drawable: The active layer
+        strength: Normal map strength multiplier
+        invert_y: Invert the Y (green) channel for different engine conventions
+        output_path: Path to save the normal map
+    """
+    pdb.gimp_image_undo_group_start(image)
+    pdb.gimp_context_push()
+    
+    try:
+        pdb.gimp_context_set_foreground(FLAT_NORMAL_COLOR)
         
-        # Apply strength by adjusting levels
-        if strength != 1.0:
-            # Adjust contrast based on strength
-            pdb.gimp_brightness_contrast(work_layer, 0, int((strength - 1.0) * 50))
+        # Duplicate the image to work non-destructively
+        work_image = pdb.gimp_image_duplicate(image)
+        work_layer = pdb.gimp_image_get_active_layer(work_image)
+        
+        work_layer = _build_normal_map(work_image, work_layer, strength, invert_y)
         
         # Ensure output directory exists
         output_dir = os.path.dirname(output_path)
-        if output_dir and not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        if output_dir:
+            _ensure_dir(output_dir)
         
         # Save the normal map
         pdb.file_png_save(work_image, work_layer, output_path, output_path,
@@ -103,6 +287,7 @@ def generate_normal_map(image, drawable, strength, invert_y, output_path):
         pdb.gimp_message("Normal map generated: {}".format(output_path))
         
     finally:
+        pdb.gimp_context_pop()
         pdb.gimp_image_undo_group_end(image)
 
 
@@ -118,13 +303,10 @@ def batch_generate_normal_maps(input_dir, output_dir, strength, invert_y, suffix
         suffix: Suffix to add to filenames
     """
     # Create output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    _ensure_dir(output_dir)
     
     # Get list of image files
-    valid_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tga')
-    image_files = [f for f in os.listdir(input_dir) 
-                  if f.lower().endswith(valid_extensions)]
+    image_files = _list_images(input_dir)
     
     if not image_files:
         pdb.gimp_message("No supported image files found in input directory!")
@@ -134,42 +316,53 @@ def batch_generate_normal_maps(input_dir, output_dir, strength, invert_y, suffix
     total = len(image_files)
     gimp.progress_init("Generating normal maps...")
     
-    # Process each image
-    for idx, filename in enumerate(image_files):
-        input_path = os.path.join(input_dir, filename)
-        
-        try:
-            # Load image
-            image = pdb.gimp_file_load(input_path, input_path)
-            drawable = pdb.gimp_image_get_active_layer(image)
-            
-            # Generate output filename
-            base_name = os.path.splitext(filename)[0]
-            output_filename = base_name + suffix + '.png'
-            output_path = os.path.join(output_dir, output_filename)
-            
-            # Generate normal map (using the single-image function logic)
-            work_image = pdb.gimp_image_duplicate(image)
-            work_layer = pdb.gimp_image_get_active_layer(work_image)
-            
-            if not pdb.gimp_drawable_has_alpha(work_layer):
-                pdb.gimp_layer_add_alpha(work_layer)
-            
-            pdb.gimp_desaturate_full(work_layer, DESATURATE_LIGHTNESS)
+    # Directory prefixes, joined once instead of per file
+    in_prefix = os.path.join(input_dir, '')
+    out_prefix = os.path.join(output_dir, '')
+    
+    # Set the fill color once for the whole batch, restoring the
+    # user's context afterwards
+    pdb.gimp_context_push()
+    pdb.gimp_context_set_foreground(FLAT_NORMAL_COLOR)
+    
+    try:
+        # Process each image
+        for idx, filename in enumerate(image_files):
+            input_path = in_prefix + filename
             
-            # Save
-            pdb.file_png_save(work_image, work_layer, output_path, output_path,
-                            0, 9, 1, 1, 1, 1, 1)
+            # Read the next file ahead while this one is processed
+            if idx + 1 < total:
+                _prefetch(in_prefix + image_files[idx + 1])
             
-            # Clean up
-            pdb.gimp_image_delete(work_image)
-            pdb.gimp_image_delete(image)
+            try:
+                # Load image
+                image = pdb.gimp_file_load(input_path, input_path)
+                
+                # The image is thrown away after export, so skip undo tracking
+                pdb.gimp_image_undo_disable(image)
+                
+                # Generate output filename
+                base_name = os.path.splitext(filename)[0]
+                output_path = out_prefix + base_name + suffix + '.png'
+                
+                # Generate normal map directly on the loaded image, which is
+                # discarded afterwards, so no duplicate is needed
+                work_layer = _build_normal_map(image, image.active_layer, strength, invert_y)
+                
+                # Save
+                pdb.file_png_save(image, work_layer, output_path, output_path,
+                                0, 9, 1, 1, 1, 1, 1)
+                
+                # Clean up
+                pdb.gimp_image_delete(image)
+                
+            except Exception as e:
+                pdb.gimp_message("Error processing {}: {}".format(filename, str(e)))
             
-        except Exception as e:
-            pdb.gimp_message("Error processing {}: {}".format(filename, str(e)))
-        
-        # Update progress
-        gimp.progress_update(float(idx + 1) / total)
+            # Update progress
+            gimp.progress_update(float(idx + 1) / total)
+    finally:
+        pdb.gimp_context_pop()
     
     pdb.gimp_message("Batch normal map generation complete! Processed {} images.".format(total))
 
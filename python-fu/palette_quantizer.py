@@ -8,8 +8,118 @@ Enforce a specific color palette across sprites for consistent game art style.
 
 from gimpfu import *
 import os
+import subprocess
+import tempfile
+import time
+from multiprocessing import cpu_count
 
-def quantize_to_palette(image, drawable, palette_name, dither_type, output_path):
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Input formats picked up by the batch function
+VALID_EXTENSIONS = frozenset(('.jpg', '.jpeg', '.png', '.bmp', '.tga'))
+
+# Minimum seconds between progress bar updates
+PROGRESS_INTERVAL = 0.1
+
+# GIMP dither modes, indexed by the "Dithering" option
+DITHER_TYPES = (CONVERT_DITHER_NONE, CONVERT_DITHER_FS, CONVERT_DITHER_FIXED)
+
+# GIMP executable used to start parallel batch workers
+GIMP_BINARY = os.environ.get("GIMP_BINARY", "gimp")
+
+# Python-Fu evaluated by each parallel batch worker; prints one result
+# line per file for the controlling plug-in to collect
+WORKER_SCRIPT = """
+import ast
+for src, dst in ast.literal_eval(open({jobs_path!r}).read()):
+    try:
+        pdb.python_fu_quantize_file(src, dst, {palette!r}, {num_colors!r}, {dither!r},
+                                    {compression!r})
+        print("QUANTIZED " + src)
+    except Exception as e:
+        print("FAILED " + src + ": " + str(e))
+"""
+
+def _ensure_dir(path):
+    """
+    Create a directory if it does not already exist.
+    Python 2 has no exist_ok, so a concurrent mkdir is tolerated here.
+    
+    Args:
+        path: Directory to create
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _list_images(input_dir):
+    """
+    List the supported image files in a directory.
+    
+    Args:
+        input_dir: Directory to scan
+    
+    Returns:
+        File names with an extension in VALID_EXTENSIONS
+    """
+    if scandir is not None:
+        names = [entry.name for entry in scandir(input_dir) if entry.is_file()]
+    else:
+        names = os.listdir(input_dir)
+    return [f for f in names if os.path.splitext(f)[1].lower() in VALID_EXTENSIONS]
+
+
+def _read_alpha(layer):
+    """
+    Read the alpha channel of a layer with alpha.
+    
+    Args:
+        layer: Layer to read
+    
+    Returns:
+        Alpha values as a bytearray, one byte per pixel
+    """
+    width = layer.width
+    height = layer.height
+    bpp = layer.bpp
+    
+    rgn = layer.get_pixel_rgn(0, 0, width, height, False, False)
+    return bytearray(rgn[0:width, 0:height])[bpp - 1::bpp]
+
+
+def _write_alpha(layer, alpha):
+    """
+    Replace the alpha channel of a layer with alpha.
+    
+    Args:
+        layer: Layer to modify
+        alpha: Alpha values from _read_alpha for a layer of the same size
+    """
+    width = layer.width
+    height = layer.height
+    bpp = layer.bpp
+    
+    src_rgn = layer.get_pixel_rgn(0, 0, width, height, False, False)
+    pixels = bytearray(src_rgn[0:width, 0:height])
+    pixels[bpp - 1::bpp] = alpha
+    
+    dst_rgn = layer.get_pixel_rgn(0, 0, width, height, True, True)
+    dst_rgn[0:width, 0:height] = bytes(pixels)
+    layer.flush()
+    layer.merge_shadow(True)
+    layer.update(0, 0, width, height)
+
+
+def quantize_to_palette(image, drawable, palette_name, dither_type, output_path, compression=6):
     """
     Quantize image colors to a specific palette.
     
@@ -19,6 +129,7 @@ def quantize_to_palette(image, drawable, palette_name, dither_type, output_path)
         palette_name: Name of the palette to use
         dither_type: Dithering method (0=None, 1=Floyd-Steinberg, 2=Fixed)
         output_path: Path to save the quantized image
+        compression: PNG zlib compression level (0-9)
     """
     pdb.gimp_image_undo_group_start(image)
     
@@ -27,14 +138,10 @@ def quantize_to_palette(image, drawable, palette_name, dither_type, output_path)
         work_image = pdb.gimp_image_duplicate(image)
         work_layer = pdb.gimp_image_get_active_layer(work_image)
         
-        # Store alpha channel if present
-        has_alpha = pdb.gimp_drawable_has_alpha(work_layer)
-        
-        if has_alpha:
-            # Extract alpha channel before conversion
-            alpha_channel = pdb.gimp_layer_copy(work_layer, True)
-            pdb.gimp_image_insert_layer(work_image, alpha_channel, None, 0)
-            pdb.gimp_desaturate_full(alpha_channel, DESATURATE_LIGHTNESS)
+        # Store alpha channel if present; indexed mode only keeps 1-bit alpha
+        alpha = None
+        if pdb.gimp_drawable_has_alpha(work_layer):
+            alpha = _read_alpha(work_layer)
         
         # Convert to indexed mode using the specified palette
         # The palette must exist in GIMP's palettes
@@ -43,9 +150,7 @@ def quantize_to_palette(image, drawable, palette_name, dither_type, output_path)
             num_colors = pdb.gimp_palette_get_info(palette_name)
             
             # Convert to indexed color using custom palette
-            pdb.gimp_image_convert_indexed(work_image, CONVERT_DITHER_NONE if dither_type == 0 
-                                          else CONVERT_DITHER_FS if dither_type == 1 
-                                          else CONVERT_DITHER_FIXED,
+            pdb.gimp_image_convert_indexed(work_image, DITHER_TYPES[dither_type],
                                           CONVERT_PALETTE_CUSTOM, num_colors, False, False, palette_name)
             
         except Exception as e:
@@ -58,24 +163,21 @@ def quantize_to_palette(image, drawable, palette_name, dither_type, output_path)
         work_layer = pdb.gimp_image_get_active_layer(work_image)
         
         # Restore alpha channel if it existed
-        if has_alpha and alpha_channel:
+        if alpha is not None:
             # Add alpha to the layer
             if not pdb.gimp_drawable_has_alpha(work_layer):
                 pdb.gimp_layer_add_alpha(work_layer)
             
-            # Copy alpha channel back
-            # This is a simplified approach - in production you'd want to properly restore alpha
-            mask = pdb.gimp_layer_create_mask(work_layer, ADD_MASK_WHITE)
-            pdb.gimp_layer_add_mask(work_layer, mask)
+            _write_alpha(work_layer, alpha)
         
         # Ensure output directory exists
         output_dir = os.path.dirname(output_path)
-        if output_dir and not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        if output_dir:
+            _ensure_dir(output_dir)
         
         # Save the quantized image
         pdb.file_png_save(work_image, work_layer, output_path, output_path,
-                        0, 9, 1, 1, 1, 1, 1)
+                        0, compression, 1, 1, 1, 1, 1)
         
         # Clean up
         pdb.gimp_image_delete(work_image)
@@ -88,7 +190,174 @@ def quantize_to_palette(image, drawable, palette_name, dither_type, output_path)
         pdb.gimp_image_undo_group_end(image)
 
 
-def batch_quantize_to_palette(input_dir, output_dir, palette_name, dither_type, suffix):
+def quantize_file(input_path, output_path, palette_name, num_colors, dither_type, compression):
+    """
+    Quantize a single image file to a palette and save it as PNG.
+    Shared by the batch loop and the parallel batch workers.
+    
+    Args:
+        input_path: Image file to load
+        output_path: Path to save the quantized image
+        palette_name: Name of the palette to use
+        num_colors: Number of colors in the palette
+        dither_type: Dithering method
+        compression: PNG zlib compression level (0-9)
+    """
+    # Load image; it is only used for this export, so convert it in
+    # place instead of working on a duplicate
+    image = pdb.gimp_file_load(input_path, input_path)
+    pdb.gimp_image_undo_disable(image)
+    
+    # Convert to indexed using palette
+    pdb.gimp_image_convert_indexed(image, DITHER_TYPES[dither_type],
+                                  CONVERT_PALETTE_CUSTOM, num_colors, 
+                                  False, False, palette_name)
+    
+    # Convert back to RGB for saving
+    pdb.gimp_image_convert_rgb(image)
+    layer = pdb.gimp_image_get_active_layer(image)
+    
+    # Save through GIMP's exporter; unlike the tileset slicer's encoder,
+    # there is one save per loaded image here, so parallelism comes from
+    # the batch workers rather than from overlapping PNG encodes
+    pdb.file_png_save(image, layer, output_path, output_path,
+                    0, compression, 1, 1, 1, 1, 1)
+    
+    # Clean up
+    pdb.gimp_image_delete(image)
+
+
+def _quantize_serial(jobs, palette_name, num_colors, dither_type, compression):
+    """
+    Quantize files one after another in this plug-in process.
+    
+    Args:
+        jobs: List of (input_path, output_path) pairs
+        palette_name: Name of the palette to use
+        num_colors: Number of colors in the palette
+        dither_type: Dithering method
+        compression: PNG zlib compression level (0-9)
+    
+    Returns:
+        Tuple of (processed, errors)
+    """
+    total = len(jobs)
+    processed = 0
+    errors = 0
+    next_update = 0
+    
+    for idx, (input_path, output_path) in enumerate(jobs):
+        try:
+            quantize_file(input_path, output_path, palette_name, num_colors,
+                          dither_type, compression)
+            processed += 1
+            
+        except Exception as e:
+            errors += 1
+            pdb.gimp_message("Error processing {}: {}".format(os.path.basename(input_path), str(e)))
+        
+        # Update progress, throttled so fast files don't flood GTK redraws
+        now = time.time()
+        if now >= next_update or idx + 1 == total:
+            gimp.progress_update(float(idx + 1) / total)
+            next_update = now + PROGRESS_INTERVAL
+    
+    return processed, errors
+
+
+def _quantize_parallel(jobs, palette_name, num_colors, dither_type, compression, workers):
+    """
+    Quantize files across several headless GIMP processes. Each worker
+    runs python_fu_quantize_file on its share of the jobs and prints one
+    result line per file.
+    
+    Args:
+        jobs: List of (input_path, output_path) pairs
+        palette_name: Name of the palette to use
+        num_colors: Number of colors in the palette
+        dither_type: Dithering method
+        compression: PNG zlib compression level (0-9)
+        workers: Number of GIMP processes to start, capped at the CPU count
+    
+    Returns:
+        Tuple of (processed, errors)
+    
+    Raises:
+        OSError: If the GIMP executable could not be started
+    """
+    total = len(jobs)
+    workers = max(1, min(workers, cpu_count(), total))
+    running = []
+    job_paths = []
+    logs = []
+    
+    try:
+        try:
+            for worker in range(workers):
+                chunk = jobs[worker::workers]
+                
+                # Pass the file list through a temp file to stay clear of
+                # command line length limits
+                job_file = tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False)
+                job_paths.append(job_file.name)
+                job_file.write(repr(chunk))
+                job_file.close()
+                
+                script = WORKER_SCRIPT.format(jobs_path=job_file.name,
+                                              palette=palette_name,
+                                              num_colors=num_colors,
+                                              dither=dither_type,
+                                              compression=compression)
+                log = tempfile.TemporaryFile()
+                logs.append(log)
+                proc = subprocess.Popen([GIMP_BINARY, "-i",
+                                         "--batch-interpreter=python-fu-eval",
+                                         "-b", script, "-b", "pdb.gimp_quit(1)"],
+                                        stdout=log, stderr=subprocess.STDOUT)
+                running.append((proc, log, len(chunk)))
+        except OSError:
+            for proc, log, count in running:
+                proc.kill()
+                proc.wait()
+            raise
+        
+        processed = 0
+        errors = 0
+        done = 0
+        
+        for proc, log, count in running:
+            proc.wait()
+            
+            # Files without a result line count as errors (e.g. worker crashed)
+            succeeded = 0
+            log.seek(0)
+            for line in log:
+                if line.startswith("QUANTIZED "):
+                    succeeded += 1
+                elif line.startswith("FAILED "):
+                    pdb.gimp_message("Error processing {}".format(line[len("FAILED "):].strip()))
+            
+            processed += succeeded
+            errors += count - succeeded
+            
+            # Update progress
+            done += count
+            gimp.progress_update(float(done) / total)
+    finally:
+        # Remove job files and logs even if a worker failed to start
+        for log in logs:
+            log.close()
+        for job_path in job_paths:
+            try:
+                os.remove(job_path)
+            except OSError:
+                pass
+    
+    return processed, errors
+
+
+def batch_quantize_to_palette(input_dir, output_dir, palette_name, dither_type, suffix,
+                              workers=1, compression=6):
     """
     Batch quantize multiple images to a palette.
     
@@ -98,83 +367,45 @@ def batch_quantize_to_palette(input_dir, output_dir, palette_name, dither_type,
         palette_name: Name of the palette to use
         dither_type: Dithering method
         suffix: Suffix to add to filenames
+        workers: Number of GIMP processes to run in parallel (1 = in-process)
+        compression: PNG zlib compression level (0-9)
     """
     # Create output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    _ensure_dir(output_dir)
     
-    # Validate palette exists
+    # Validate palette exists, looking up its size once for the batch
     try:
-        pdb.gimp_palette_get_info(palette_name)
+        num_colors = pdb.gimp_palette_get_info(palette_name)
     except:
         pdb.gimp_message("Error: Palette '{}' not found! Please check the palette name.".format(palette_name))
         return
     
     # Get list of image files
-    valid_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tga')
-    image_files = [f for f in os.listdir(input_dir) 
-                  if f.lower().endswith(valid_extensions)]
+    image_files = _list_images(input_dir)
     
     if not image_files:
         pdb.gimp_message("No supported image files found in input directory!")
         return
     
+    # Pair each input with its output path; directory prefixes are
+    # joined once instead of per file
+    in_prefix = os.path.join(input_dir, '')
+    out_prefix = os.path.join(output_dir, '')
+    jobs = [(in_prefix + filename, out_prefix + os.path.splitext(filename)[0] + suffix + '.png')
+            for filename in image_files]
+    
     # Initialize progress
-    total = len(image_files)
     gimp.progress_init("Quantizing to palette...")
     
-    processed = 0
-    errors = 0
-    
-    # Process each image
-    for idx, filename in enumerate(image_files):
-        input_path = os.path.join(input_dir, filename)
-        
+    if workers > 1 and len(jobs) > 1:
         try:
-            # Load image
-            image = pdb.gimp_file_load(input_path, input_path)
-            drawable = pdb.gimp_image_get_active_layer(image)
-            
-            # Duplicate for processing
-            work_image = pdb.gimp_image_duplicate(image)
-            work_layer = pdb.gimp_image_get_active_layer(work_image)
-            
-            # Get number of colors in palette
-            num_colors = pdb.gimp_palette_get_info(palette_name)
-            
-            # Convert to indexed using palette
-            pdb.gimp_image_convert_indexed(work_image, 
-                                          CONVERT_DITHER_NONE if dither_type == 0 
-                                          else CONVERT_DITHER_FS if dither_type == 1 
-                                          else CONVERT_DITHER_FIXED,
-                                          CONVERT_PALETTE_CUSTOM, num_colors, 
-                                          False, False, palette_name)
-            
-            # Convert back to RGB for saving
-            pdb.gimp_image_convert_rgb(work_image)
-            work_layer = pdb.gimp_image_get_active_layer(work_image)
-            
-            # Generate output filename
-            base_name = os.path.splitext(filename)[0]
-            output_filename = base_name + suffix + '.png'
-            output_path = os.path.join(output_dir, output_filename)
-            
-            # Save
-            pdb.file_png_save(work_image, work_layer, output_path, output_path,
-                            0, 9, 1, 1, 1, 1, 1)
-            
-            # Clean up
-            pdb.gimp_image_delete(work_image)
-            pdb.gimp_image_delete(image)
-            
-            processed += 1
-            
-        except Exception as e:
-            errors += 1
-            pdb.gimp_message("Error processing {}: {}".format(filename, str(e)))
-        
-        # Update progress
-        gimp.progress_update(float(idx + 1) / total)
+            processed, errors = _quantize_parallel(jobs, palette_name, num_colors,
+                                                   dither_type, compression, workers)
+        except OSError as e:
+            pdb.gimp_message("Could not start GIMP workers ({}), processing in a single process.".format(str(e)))
+            processed, errors = _quantize_serial(jobs, palette_name, num_colors, dither_type, compression)
+    else:
+        processed, errors = _quantize_serial(jobs, palette_name, num_colors, dither_type, compression)
     
     pdb.gimp_message("Batch quantization complete!\nProcessed: {}\nErrors: {}".format(processed, errors))
 
@@ -193,7 +424,8 @@ register(
         (PF_STRING, "palette_name", "Palette Name:", ""),
         (PF_OPTION, "dither_type", "Dithering:", 1, 
          ["None", "Floyd-Steinberg", "Fixed"]),
-        (PF_FILE, "output_path", "Output Path:", "")
+        (PF_FILE, "output_path", "Output Path:", ""),
+        (PF_SPINNER, "compression", "PNG Compression:", 6, (0, 9, 1))
     ],
     [],
     quantize_to_palette
@@ -215,10 +447,34 @@ register(
         (PF_STRING, "palette_name", "Palette Name:", ""),
         (PF_OPTION, "dither_type", "Dithering:", 1, 
          ["None", "Floyd-Steinberg", "Fixed"]),
-        (PF_STRING, "suffix", "Filename Suffix:", "_quantized")
+        (PF_STRING, "suffix", "Filename Suffix:", "_quantized"),
+        (PF_SPINNER, "workers", "Parallel Workers:", 1, (1, 64, 1)),
+        (PF_SPINNER, "compression", "PNG Compression:", 6, (0, 9, 1))
     ],
     [],
     batch_quantize_to_palette
 )
 
+# Register per-file function used by parallel batch workers (no menu entry)
+register(
+    "python_fu_quantize_file",
+    "Quantize an image file to palette",
+    "Load an image file, quantize it to a palette and save it as PNG. Used by parallel batch workers.",
+    "Python-Fu GIMP Automation",
+    "Python-Fu GIMP Automation",
+    "2024",
+    "",
+    "",
+    [
+        (PF_FILE, "input_path", "Input Path:", ""),
+        (PF_FILE, "output_path", "Output Path:", ""),
+        (PF_STRING, "palette_name", "Palette Name:", ""),
+        (PF_INT, "num_colors", "Number of Colors:", 0),
+        (PF_INT, "dither_type", "Dithering:", 1),
+        (PF_SPINNER, "compression", "PNG Compression:", 6, (0, 9, 1))
+    ],
+    [],
+    quantize_file
+)
+
 main()
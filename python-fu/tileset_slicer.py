@@ -8,8 +8,118 @@ Slice a tileset image into individual sprite tiles for game development.
 
 from gimpfu import *
 import os
+import struct
+import threading
+import time
+import zlib
+from multiprocessing import cpu_count
 
-def slice_tileset(image, drawable, tile_width, tile_height, margin, spacing, output_dir, filename_prefix):
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import imagecodecs
+    import numpy as np
+except ImportError:
+    imagecodecs = None
+
+# Minimum seconds between progress bar updates
+PROGRESS_INTERVAL = 0.1
+
+# PNG color type for each layer bytes-per-pixel (gray, gray+alpha, RGB, RGBA)
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+
+def _ensure_dir(path):
+    """
+    Create a directory if it does not already exist.
+    Python 2 has no exist_ok, so a concurrent mkdir is tolerated here.
+    
+    Args:
+        path: Directory to create
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _png_chunk(tag, data):
+    """
+    Build a PNG chunk with its length and CRC.
+    
+    Args:
+        tag: Four-byte chunk type
+        data: Chunk payload
+    
+    Returns:
+        The encoded chunk
+    """
+    chunk = tag + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+
+
+def _encode_png(pixels, width, height, bpp, compression):
+    """
+    Encode raw 8-bit pixel data, as read from a pixel region, as a PNG.
+    Uses imagecodecs' faster encoder when it is installed.
+    
+    Args:
+        pixels: Pixel data, row by row
+        width: Width in pixels
+        height: Height in pixels
+        bpp: Bytes per pixel (1-4)
+        compression: zlib compression level (0-9)
+    
+    Returns:
+        The PNG file contents
+    """
+    if imagecodecs is not None:
+        shape = (height, width) if bpp == 1 else (height, width, bpp)
+        data = np.frombuffer(pixels, dtype=np.uint8).reshape(shape)
+        return imagecodecs.png_encode(data, level=compression)
+    
+    stride = width * bpp
+    
+    # Every row starts with filter type 0 (none)
+    raw = b"".join(b"\x00" + pixels[y * stride:(y + 1) * stride] for y in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[bpp], 0, 0, 0)
+    
+    return (b"\x89PNG\r\n\x1a\n" +
+            _png_chunk(b"IHDR", header) +
+            _png_chunk(b"IDAT", zlib.compress(raw, compression)) +
+            _png_chunk(b"IEND", b""))
+
+
+def _save_tiles(jobs, errors):
+    """
+    Encode and write queued tiles until a None job is received. zlib
+    releases the GIL while compressing, so several of these threads
+    encode in parallel.
+    
+    Args:
+        jobs: Queue of (path, pixels, width, height, bpp, compression)
+        errors: List collecting (path, exception) for failed writes
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        
+        output_path, pixels, width, height, bpp, compression = job
+        try:
+            data = _encode_png(pixels, width, height, bpp, compression)
+            with open(output_path, 'wb') as f:
+                f.write(data)
+        except Exception as e:
+            errors.append((output_path, e))
+
+
+def slice_tileset(image, drawable, tile_width, tile_height, margin, spacing, output_dir, filename_prefix,
+                  compression=6):
     """
     Slice a tileset into individual tiles.
     
@@ -22,14 +132,14 @@ def slice_tileset(image, drawable, tile_width, tile_height, margin, spacing, out
         spacing: Spacing between tiles
         output_dir: Directory to save tiles
         filename_prefix: Prefix for output filenames
+        compression: PNG zlib compression level (0-9)
     """
     # Create output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    _ensure_dir(output_dir)
     
-    # Calculate number of tiles
-    img_width = image.width
-    img_height = image.height
+    # Calculate number of tiles from the layer being sliced
+    img_width = drawable.width
+    img_height = drawable.height
     
     # Account for margins and spacing
     usable_width = img_width - (2 * margin)
@@ -47,43 +157,58 @@ def slice_tileset(image, drawable, tile_width, tile_height, margin, spacing, out
     gimp.progress_init("Slicing tileset...")
     
     tile_index = 0
+    next_update = 0
+    
+    # Read tiles straight from the layer instead of going through the
+    # selection and clipboard
+    src_rgn = drawable.get_pixel_rgn(0, 0, img_width, img_height, False, False)
+    bpp = drawable.bpp
     
-    # Extract each tile
-    for row in range(rows):
-        for col in range(cols):
-            # Calculate position
-            x = margin + col * (tile_width + spacing)
-            y = margin + row * (tile_height + spacing)
-            
-            # Create a new image for this tile
-            tile_image = pdb.gimp_image_new(tile_width, tile_height, RGB)
-            tile_layer = pdb.gimp_layer_new(tile_image, tile_width, tile_height, 
-                                           RGBA_IMAGE, "tile", 100, NORMAL_MODE)
-            pdb.gimp_image_insert_layer(tile_image, tile_layer, None, 0)
-            
-            # Copy the tile region
-            pdb.gimp_image_select_rectangle(image, CHANNEL_OP_REPLACE, x, y, tile_width, tile_height)
-            pdb.gimp_edit_copy(drawable)
-            
-            # Paste into new image
-            floating = pdb.gimp_edit_paste(tile_layer, False)
-            pdb.gimp_floating_sel_anchor(floating)
-            
-            # Clear selection
-            pdb.gimp_selection_none(image)
-            
-            # Save the tile
-            output_filename = "{}{:04d}.png".format(filename_prefix, tile_index)
-            output_path = os.path.join(output_dir, output_filename)
-            pdb.file_png_save(tile_image, tile_layer, output_path, output_path,
-                            0, 9, 1, 1, 1, 1, 1)
-            
-            # Clean up
-            pdb.gimp_image_delete(tile_image)
-            
-            # Update progress
-            tile_index += 1
-            gimp.progress_update(float(tile_index) / total_tiles)
+    # Output path up to the tile number, joined once instead of per tile
+    output_prefix = os.path.join(output_dir, filename_prefix)
+    
+    # PNG encoding runs on background threads while this thread reads
+    # pixels; the bounded queue keeps only a few tiles in memory
+    num_threads = max(1, min(cpu_count(), 8))
+    jobs = queue.Queue(maxsize=num_threads * 4)
+    errors = []
+    threads = [threading.Thread(target=_save_tiles, args=(jobs, errors))
+               for _ in range(num_threads)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    
+    try:
+        # Extract each tile
+        for row in range(rows):
+            for col in range(cols):
+                # Calculate position
+                x = margin + col * (tile_width + spacing)
+                y = margin + row * (tile_height + spacing)
+                
+                # Queue the tile for saving
+                output_path = output_prefix + "{:04d}.png".format(tile_index)
+                pixels = src_rgn[x:x + tile_width, y:y + tile_height]
+                jobs.put((output_path, pixels, tile_width, tile_height, bpp, compression))
+                
+                # Update progress, throttled so small tiles don't flood GTK redraws
+                tile_index += 1
+                now = time.time()
+                if now >= next_update or tile_index == total_tiles:
+                    gimp.progress_update(float(tile_index) / total_tiles)
+                    next_update = now + PROGRESS_INTERVAL
+    finally:
+        # Let the writers drain the queue and exit
+        for _ in threads:
+            jobs.put(None)
+        for thread in threads:
+            thread.join()
+    
+    if errors:
+        output_path, e = errors[0]
+        pdb.gimp_message("Error: {} of {} tiles could not be saved ({}: {})".format(
+            len(errors), total_tiles, output_path, str(e)))
+        return
     
     pdb.gimp_message("Slicing complete! Exported {} tiles to {}".format(total_tiles, output_dir))
 
@@ -103,7 +228,8 @@ register(
         (PF_INT, "margin", "Margin (px):", 0),
         (PF_INT, "spacing", "Spacing (px):", 0),
         (PF_DIRNAME, "output_dir", "Output Directory:", ""),
-        (PF_STRING, "filename_prefix", "Filename Prefix:", "tile_")
+        (PF_STRING, "filename_prefix", "Filename Prefix:", "tile_"),
+        (PF_SPINNER, "compression", "PNG Compression:", 6, (0, 9, 1))
     ],
     [],
     slice_tileset